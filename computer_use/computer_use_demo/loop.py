@@ -1,14 +1,25 @@
 """
 Agentic sampling loop that calls the Anthropic API and local implementation of anthropic-defined computer use tools.
 """
+import asyncio
+import base64
+import functools
+import hashlib
+import io
+import mimetypes
 import os
 import platform
+import re
+import threading
+from collections import OrderedDict
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import StrEnum
 from typing import Any, cast
 
 import httpx
+import msgspec
 from anthropic import (
     Anthropic,
     AnthropicBedrock,
@@ -28,6 +39,7 @@ from anthropic.types.beta import (
     BetaToolResultBlockParam,
     BetaToolUseBlockParam,
 )
+from PIL import Image
 
 from .tools import (
     TOOL_GROUPS_BY_VERSION,
@@ -37,14 +49,22 @@ from .tools import (
 )
 
 PROMPT_CACHING_BETA_FLAG = "prompt-caching-2024-07-31"
+# Best-effort hint that the unchanged system prefix can be cached across turns.
+# `cache_prompt` is a llama.cpp server field; vLLM-style servers cache prefixes
+# on the server side. Whether Nebius honours or rejects it is unverified.
+PROMPT_CACHING_EXTRA_BODY = {"cache_prompt": True}
 
 
 class APIProvider(StrEnum):
     NEBIUS = "nebius"
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 import json
 
+# Screen size as advertised to the models, read once at import. The defaults keep
+# the module importable without WIDTH/HEIGHT; the computer tool still requires them.
+SCREEN_WIDTH = int(os.environ.get("WIDTH", "1280"))
+SCREEN_HEIGHT = int(os.environ.get("HEIGHT", "800"))
 
 # This system prompt is optimized for the Docker environment in this repository and
 # specific tool combinations enabled.
@@ -55,36 +75,17 @@ SYSTEM_PROMPT = f"""<SYSTEM_CAPABILITY>
 * You are utilising an Ubuntu virtual machine using {platform.machine()} architecture with internet access.
 * You can only take screenshots, move a mouse and do a left click. 
 * If you are not sure of location of something, ALWAYS take screenshot to verify it. 
-* You can assume that the size of a screen is width = {int(os.getenv("WIDTH"))} , height = {int(os.getenv("HEIGHT"))}.
+* You can assume that the size of a screen is width = {SCREEN_WIDTH} , height = {SCREEN_HEIGHT}.
 """
 
 vision_model = "Qwen/Qwen2-VL-72B-Instruct"
 
+# Load the system MIME database at import rather than on the first image read.
+mimetypes.init()
 
-async def sampling_loop(
-    *,
-    model: str,
-    provider = None,
-    system_prompt_suffix = None,
-    messages,
-    output_callback = None,
-    tool_output_callback = None,
-    api_response_callback = None,
-    api_key: str,
-    only_n_most_recent_images: int | None = None,
-    max_tokens: int = 4096,
-    thinking_budget: int = 256,
-    tool_version: ToolVersion = 'computer_use_20250124',
-):
-    """
-    Agentic sampling loop for the assistant/tool interaction of computer use.
-    """
-
-
-    tool_group = TOOL_GROUPS_BY_VERSION[tool_version]
-    tool_collection = ToolCollection(*(ToolCls() for ToolCls in tool_group.tools))
-
-    tool = {
+# Function schema of the computer tool as exposed to the Nebius model. Built once
+# at import; every request references the same object.
+TOOL_SCHEMA = {
     "type": "function",
     "function": {
         "name": "computer",
@@ -116,74 +117,222 @@ async def sampling_loop(
         }
     }
 }
-    system = SYSTEM_PROMPT
-
-    while True:
-        client = client = OpenAI(
-                # do **not** include /v1 twice – the SDK appends /chat/completions itself
-                base_url="https://api.studio.nebius.ai/v1/",
-                api_key=api_key,                                
-            )
-
 
+VISION_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": f"""You describe screenshots for a desktop-control agent. You are given context of a conversation, and the last message is an image that you have to describe. 
+            You can assume that the size of a screen is width = {SCREEN_WIDTH} , height = {SCREEN_HEIGHT}.
+            Make sure to always give EXACT coordinates of what are you seeing.""",
+}
 
+_JSON_ENCODER = msgspec.json.Encoder()
+
+# Upper bound on history messages sent per request (system message excluded).
+MAX_REQUEST_MESSAGES = 60
+
+# LRU of vision summaries keyed by a digest of the screenshot bytes. A click-loop
+# re-captures an unchanged screen constantly, and each miss is a full 72B
+# multimodal inference. Only exact matches count: after a click the agent
+# screenshots to verify it, and a change as small as a ticked checkbox must
+# get a fresh description.
+VISION_CACHE_SIZE = 64
+_VISION_CACHE: "OrderedDict[str, str]" = OrderedDict()
+# Every Streamlit session runs its loop on its own script thread and they all
+# share the cache, so each lookup and insert holds this lock.
+_VISION_CACHE_LOCK = threading.Lock()
+VISION_BATCH_SEPARATOR = "---"
+# Models often widen the separator into a longer rule; only whole lines count,
+# so a "---" inside a description does not split it.
+_VISION_BATCH_SEPARATOR_RE = re.compile(r"^\s*-{3,}\s*$", re.MULTILINE)
+# Cap on simultaneous vision requests when screenshots are summarized one by one,
+# to stay within the provider's rate limits.
+MAX_CONCURRENT_VISION_REQUESTS = 8
+
+# Decoding, hashing and re-encoding multi-MB screenshots is CPU-bound; it runs
+# here so it does not stall the event loop driving the API calls. A dedicated
+# small pool keeps many gathered vision calls from each claiming a thread.
+_IMAGE_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="vision-image")
 
-        # Call the API
-        # we use raw_response to provide debug information to streamlit. Your
-        # implementation may be able call the SDK directly with:
-        # `response = client.messages.create(...)` instead.
-        raw_response = client.chat.completions.with_raw_response.create(
-            model=model,
-            messages=[{"role": "system", "content": system}, *messages],
-            tool_choice="auto",
-            tools=[tool], 
-            max_tokens=max_tokens
-        )
-            
 
-        api_response_callback(
-            raw_response.http_response.request, raw_response.http_response, None
-        )
+async def sampling_loop(
+    *,
+    model: str,
+    provider = None,
+    system_prompt_suffix = None,
+    messages,
+    output_callback = None,
+    output_delta_callback = None,
+    tool_output_callback = None,
+    api_response_callback = None,
+    api_key: str,
+    only_n_most_recent_images: int | None = None,
+    max_tokens: int = 4096,
+    thinking_budget: int = 256,
+    tool_version: ToolVersion = 'computer_use_20250124',
+):
+    """
+    Agentic sampling loop for the assistant/tool interaction of computer use.
+    """
 
 
+    tool_group = TOOL_GROUPS_BY_VERSION[tool_version]
+    tool_collection = ToolCollection(*(ToolCls() for ToolCls in tool_group.tools))
 
-        
-        response = raw_response.parse()
-        
-        response = response.choices[0].message
-
-        output_callback(response.content or "")
- 
-        messages.append(
-            {
-                "role": "assistant",
-                "content": response.content or "",
-                "tool_calls": response.tool_calls or [],
-            }
+    # The system message is identical for every turn; build it once so the
+    # request prefix stays byte-stable for the server's prefix cache.
+    system = {
+        "role": "system",
+        "content": f"{SYSTEM_PROMPT}{' ' + system_prompt_suffix if system_prompt_suffix else ''}",
+    }
+    tool_lock = asyncio.Lock()
+
+    # One client (and so one connection pool) for every completion and vision
+    # call of this loop, so requests reuse warm keep-alive connections instead
+    # of paying a fresh TCP+TLS handshake each iteration. Over HTTP/2 the
+    # concurrent vision and completion requests share one multiplexed connection.
+    event_hooks = {}
+    if api_response_callback is not None:
+        # Report every exchange (completions and vision calls) from the
+        # transport, so the SDK can parse responses in a single pass.
+        async def _on_response(response: httpx.Response):
+            api_response_callback(response.request, response, None)
+
+        event_hooks["response"] = [_on_response]
+    client = AsyncOpenAI(
+            # do **not** include /v1 twice – the SDK appends /chat/completions itself
+            base_url="https://api.studio.nebius.ai/v1/",
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                timeout=httpx.Timeout(60.0, connect=5.0),
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+                event_hooks=event_hooks,
+            ),
         )
 
-        tool_result_content = []
-        # inside your loop, instead of calling the real screenshot tool:
-        
-
-        for tool_call in response.tool_calls:
-            
+    async def _handle_call(tool_call: dict, tool_input: dict):
+        # The actions drive a single display, so they execute in the order
+        # the model emitted them.
+        async with tool_lock:
             result = await tool_collection.run(
-                name=tool_call.function.name,
-                tool_input= json.loads(tool_call.function.arguments),
+                name=tool_call["function"]["name"],
+                tool_input=tool_input,
+            )
+        return result, tool_call["id"]
+
+    # Closing the client closes its connection pool; Streamlit runs every
+    # sampling_loop call in a fresh event loop, so nothing can be kept alive.
+    async with client:
+        while True:
+            # Call the API
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    system,
+                    *_maybe_filter_to_n_most_recent_images(
+                        _trim_to_request_window(messages, MAX_REQUEST_MESSAGES),
+                        only_n_most_recent_images,
+                    ),
+                ],
+                tool_choice="auto",
+                tools=[TOOL_SCHEMA],
+                max_tokens=max_tokens,
+                extra_body=PROMPT_CACHING_EXTRA_BODY,
+                stream=True,
             )
-            tool_result_content.append(
-                _make_api_tool_result(client=client,result=result, tool_call_id=tool_call.id, context=messages)
+
+            # Stream the reply: text is forwarded as it arrives, and each tool call
+            # is dispatched as soon as its arguments form complete JSON, so tools
+            # run while the model is still generating the rest of the turn.
+            content = ""
+            partial_tool_calls: dict[int, dict] = {}
+            tool_tasks: dict[int, asyncio.Task] = {}
+            # The task group cancels in-flight tool calls if the stream fails. A
+            # single failure is re-raised as itself rather than as an
+            # ExceptionGroup, so callers see the same errors as without streaming.
+            try:
+                async with asyncio.TaskGroup() as task_group:
+                    async for chunk in stream:
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta
+                        if delta.content:
+                            content += delta.content
+                            if output_delta_callback:
+                                output_delta_callback(delta.content)
+                        for tool_call_delta in delta.tool_calls or []:
+                            index = tool_call_delta.index
+                            tool_call = partial_tool_calls.setdefault(
+                                index,
+                                {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
+                            )
+                            if tool_call_delta.id:
+                                tool_call["id"] = tool_call_delta.id
+                            if tool_call_delta.function:
+                                tool_call["function"]["name"] += tool_call_delta.function.name or ""
+                                tool_call["function"]["arguments"] += tool_call_delta.function.arguments or ""
+                            if index in tool_tasks:
+                                continue
+                            try:
+                                tool_input = json.loads(tool_call["function"]["arguments"])
+                            except ValueError:
+                                continue
+                            tool_tasks[index] = task_group.create_task(_handle_call(tool_call, tool_input))
+
+                    tool_calls = [partial_tool_calls[index] for index in sorted(partial_tool_calls)]
+                    for index, tool_call in sorted(partial_tool_calls.items()):
+                        if index not in tool_tasks:
+                            tool_tasks[index] = task_group.create_task(
+                                _handle_call(tool_call, json.loads(tool_call["function"]["arguments"] or "{}"))
+                            )
+
+                    output_callback(content)
+            except* Exception as group:
+                if len(group.exceptions) == 1:
+                    raise group.exceptions[0] from None
+                raise
+
+            # History holds plain dicts only (no SDK models), so replaying it on
+            # later turns needs no pydantic round-trip and it encodes as-is.
+            assistant_message = {"role": "assistant", "content": content}
+            if tool_calls:
+                assistant_message["tool_calls"] = [
+                    {
+                        "id": tool_call["id"],
+                        "type": "function",
+                        "function": {
+                            "name": tool_call["function"]["name"],
+                            "arguments": tool_call["function"]["arguments"],
+                        },
+                    }
+                    for tool_call in tool_calls
+                ]
+            messages.append(assistant_message)
+
+            context = _maybe_filter_to_n_most_recent_images(
+                _trim_to_request_window(messages, MAX_REQUEST_MESSAGES),
+                only_n_most_recent_images,
             )
 
+            results = [tool_tasks[index].result() for index in sorted(tool_tasks)]
 
-            tool_output_callback(result, tool_call.id)
+            # Describe every screenshot of this turn with a single vision request
+            # rather than one round-trip per image.
+            images = [result.base64_image for result, _ in results if result.base64_image]
+            summaries = iter(await summarize_images_batch(client, images, context))
 
+            tool_result_content = []
+            for result, tool_call_id in results:
+                image_summary = next(summaries) if result.base64_image else None
+                tool_result_content.append(
+                    _make_api_tool_result(result=result, tool_call_id=tool_call_id, image_summary=image_summary)
+                )
+                tool_output_callback(result, tool_call_id)
 
-        if not tool_result_content:
-            return messages
+            if not tool_result_content:
+                return messages
         
-        messages.extend(tool_result_content)
+            messages.extend(tool_result_content)
         
         
         
@@ -195,52 +344,240 @@ async def sampling_loop(
 
 
 
-def _make_api_tool_result(result: ToolResult, tool_call_id: str, client, context) -> dict:
+def _trim_to_request_window(messages: list[dict], max_messages: int) -> list[dict]:
+    """
+    Return at most about `max_messages` of the most recent messages, so request
+    size stays bounded however long the session runs. The window never starts
+    on a tool message (its assistant tool call would be missing), and the first
+    user message, which states the task, is kept when it falls outside.
+    """
+    if len(messages) <= max_messages:
+        return messages
+
+    start = len(messages) - max_messages
+    while start < len(messages) and messages[start].get("role") == "tool":
+        start += 1
+    window = messages[start:]
+    if messages[0].get("role") == "user":
+        window.insert(0, messages[0])
+    return window
+
+
+def _maybe_filter_to_n_most_recent_images(messages: list[dict], images_to_keep: int | None) -> list[dict]:
+    """
+    Return a copy of messages where all but the `images_to_keep` most recent
+    images are replaced by placeholders. Images are `image_url`/`image` parts
+    of multimodal messages and the `image` entry of tool result payloads.
+    Messages that need rewriting are copied; the input is never mutated.
+    """
+    if images_to_keep is None:
+        return messages
+
+    filtered = list(messages)
+    seen = 0
+    for i in range(len(filtered) - 1, -1, -1):
+        message = filtered[i]
+        content = message.get("content")
+        if message.get("role") == "tool" and isinstance(content, str):
+            try:
+                payload = msgspec.json.decode(content)
+            except msgspec.DecodeError:
+                continue
+            if not isinstance(payload, dict) or "image" not in payload or payload["image"] == {"omitted": True}:
+                continue
+            seen += 1
+            if seen > images_to_keep:
+                payload["image"] = {"omitted": True}
+                filtered[i] = {**message, "content": _JSON_ENCODER.encode(payload).decode()}
+        elif isinstance(content, list):
+            new_content = []
+            for part in reversed(content):
+                if isinstance(part, dict) and part.get("type") in ("image_url", "image"):
+                    seen += 1
+                    if seen > images_to_keep:
+                        part = {"type": "text", "text": "[image omitted]"}
+                new_content.append(part)
+            new_content.reverse()
+            if new_content != content:
+                filtered[i] = {**message, "content": new_content}
+    return filtered
+
+
+def _make_api_tool_result(result: ToolResult, tool_call_id: str, image_summary: str | None = None) -> dict:
     """
     Turn ToolResult into an OpenAI Chat Completions 'tool' message.
-    content MUST be a string; we JSON-encode the payload.
+    content MUST be a string; we JSON-encode the payload. Screenshots are sent
+    as their vision summary (`image_summary`) rather than the image itself.
     """
     payload = {}
     
     if getattr(result, "error", None):
         payload["error"] = result.error
-    if getattr(result, "base64_image", None):
+    if image_summary is not None:
         payload["image"] = {
             "type": "base64",
             "media_type": "image/png",
-            "data": summarize_image_with_vision(client, vision_model, result.base64_image, context),
+            "data": image_summary,
         }
     return {
         "role": "tool",
         "tool_call_id": tool_call_id,
-        "content": json.dumps(payload, ensure_ascii=False),
+        "content": _JSON_ENCODER.encode(payload).decode(),
     }
 
-def summarize_image_with_vision(client, vision_model: str, b64_png: str, context) -> str:
-    """Return a short textual description for a PNG base64 image (no data: prefix)."""
+async def _summarize_screenshot(
+    client, vision_model: str, fingerprint: tuple[bytes, str], context
+) -> str:
+    """Describe an already fingerprinted screenshot that missed the cache, and cache the result."""
+    png, key = fingerprint
     try:
-        system = {"role": "system",
-                 "content": f"""You describe screenshots for a desktop-control agent. You are given context of a conversation, and the last message is an image that you have to describe. 
-                 You can assume that the size of a screen is width = {int(os.getenv("WIDTH"))} , height = {int(os.getenv("HEIGHT"))}.
-                 Make sure to always give EXACT coordinates of what are you seeing."""
-                 }
+        b64_jpeg = await _run_image_work(_png_to_jpeg_b64, png)
+        system = VISION_SYSTEM_MESSAGE
         prompt = {"role": "user", "content": 
-                    [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_png}"}}]
+                    [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_jpeg}"}}]
                 }
-        resp = client.chat.completions.with_raw_response.create(
+        resp = await client.chat.completions.create(
             model=vision_model, 
             messages=[system]+context+[prompt],
             max_tokens=120,
+            extra_body=PROMPT_CACHING_EXTRA_BODY,
         )
-        resp = resp.parse()
-        return resp.choices[0].message.content or ""
+        summary = resp.choices[0].message.content or ""
     except Exception as e:
         return f"[vision summary failed: {e}]"
+    _remember_summary(key, summary)
+    return summary
+
+
+async def summarize_images_batch(client, b64_pngs: list[str], context) -> list[str]:
+    """
+    Return one summary per PNG base64 image, in order. Cached images are not
+    re-sent; the remaining ones are described by a single vision request, and
+    fall back to one request per image if the reply cannot be split. Errors
+    from the batched request are raised.
+    """
+    fingerprints = await asyncio.gather(
+        *(_run_image_work(_fingerprint_screenshot, b64_png) for b64_png in b64_pngs)
+    )
+    summaries: list[str | None] = [_cached_summary(key) for _, key in fingerprints]
+
+    # A screen captured twice in one turn is described once, and the summary
+    # is shared by every image with that digest.
+    indices_by_key: dict[str, list[int]] = {}
+    for i, (summary, (_, key)) in enumerate(zip(summaries, fingerprints)):
+        if summary is None:
+            indices_by_key.setdefault(key, []).append(i)
+    missing = [fingerprints[indices[0]] for indices in indices_by_key.values()]
+
+    if len(missing) == 1:
+        described = [await _summarize_screenshot(client, vision_model, missing[0], context)]
+    elif missing:
+        # Only a reply that cannot be split falls back to one request per image;
+        # API errors (auth, rate limits) would fail those the same way, so they
+        # propagate.
+        described = None
+        b64_jpegs = await asyncio.gather(
+            *(_run_image_work(_png_to_jpeg_b64, png) for png, _ in missing)
+        )
+        prompt = {"role": "user", "content": [
+            *(
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_jpeg}"}}
+                for b64_jpeg in b64_jpegs
+            ),
+            {"type": "text", "text": f"Describe each of these {len(missing)} images in order, separated by a line containing only '{VISION_BATCH_SEPARATOR}'."},
+        ]}
+        resp = await client.chat.completions.create(
+            model=vision_model,
+            messages=[VISION_SYSTEM_MESSAGE]+context+[prompt],
+            max_tokens=120 * len(missing),
+            extra_body=PROMPT_CACHING_EXTRA_BODY,
+        )
+        content = resp.choices[0].message.content or ""
+        parts = _split_batch_summaries(content)
+        if len(parts) == len(missing):
+            described = parts
 
+        if described is None:
+            # Created per call: asyncio primitives bind to one event loop, and
+            # Streamlit runs each rerun in a fresh one.
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_VISION_REQUESTS)
 
-import base64, mimetypes, os
+            async def _summarize(fingerprint: tuple[bytes, str]) -> str:
+                async with semaphore:
+                    return await _summarize_screenshot(client, vision_model, fingerprint, context)
 
-def read_image_b64(path: str):
-    mt, _ = mimetypes.guess_type(path)
+            async with asyncio.TaskGroup() as task_group:
+                tasks = [task_group.create_task(_summarize(fingerprint)) for fingerprint in missing]
+            described = [task.result() for task in tasks]
+        else:
+            for (_, key), summary in zip(missing, described):
+                _remember_summary(key, summary)
+    else:
+        described = []
+
+    for indices, summary in zip(indices_by_key.values(), described):
+        for i in indices:
+            summaries[i] = summary
+
+    return cast(list[str], summaries)
+
+
+def _split_batch_summaries(content: str) -> list[str]:
+    """Split a batched vision reply into its per-image descriptions."""
+    parts = (part.strip() for part in _VISION_BATCH_SEPARATOR_RE.split(content))
+    return [part for part in parts if part]
+
+
+def _cached_summary(key: str) -> str | None:
+    """Look up the summary of a screenshot by the digest of its bytes."""
+    with _VISION_CACHE_LOCK:
+        if key in _VISION_CACHE:
+            _VISION_CACHE.move_to_end(key)
+            return _VISION_CACHE[key]
+    return None
+
+
+def _remember_summary(key: str, summary: str):
+    with _VISION_CACHE_LOCK:
+        _VISION_CACHE[key] = summary
+        if len(_VISION_CACHE) > VISION_CACHE_SIZE:
+            _VISION_CACHE.popitem(last=False)
+
+
+async def _run_image_work(func: Callable[..., Any], *args: Any) -> Any:
+    """Run CPU-bound image work (base64, hashing, PIL) on the image worker pool."""
+    return await asyncio.get_running_loop().run_in_executor(_IMAGE_EXECUTOR, func, *args)
+
+
+def _fingerprint_screenshot(b64_png: str) -> tuple[bytes, str]:
+    """Decode a base64 PNG; return its bytes and digest."""
+    png = base64.b64decode(b64_png)
+    return png, _image_digest(png)
+
+
+def _image_digest(image: bytes) -> str:
+    return hashlib.blake2b(image, digest_size=16).hexdigest()
+
+
+def _png_to_jpeg_b64(png: bytes) -> str:
+    """
+    Re-encode a PNG screenshot as a base64 JPEG for upload to the vision model.
+    Desktop PNGs are several times larger on the wire; the resolution is kept
+    as-is because the model is asked for exact screen coordinates.
+    """
+    image = Image.open(io.BytesIO(png)).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=70, optimize=True)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def read_image_b64(path: str) -> tuple[str, str]:
+    """Return the base64 contents of an image file and its media type."""
     with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8"), (mt or "image/jpeg")
\ No newline at end of file
+        data = f.read()
+    return base64.b64encode(data).decode("ascii"), _guess_image_media_type(os.path.splitext(path)[1].lower())
+
+
+@functools.lru_cache(maxsize=64)
+def _guess_image_media_type(extension: str) -> str:
+    return mimetypes.types_map.get(extension, "image/jpeg")
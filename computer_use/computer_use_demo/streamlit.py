@@ -15,6 +15,7 @@ from pathlib import PosixPath
 from typing import cast
 
 import httpx
+import msgspec
 import streamlit as st
 from streamlit.delta_generator import DeltaGenerator
 
@@ -65,6 +66,9 @@ def setup_state():
         st.session_state.responses = {}
     if "tools" not in st.session_state:
         st.session_state.tools = {}
+    if "screenshots" not in st.session_state:
+        # decoded tool screenshots by tool call id, so reruns skip the base64 decode
+        st.session_state.screenshots = {}
     if "only_n_most_recent_images" not in st.session_state:
         st.session_state.only_n_most_recent_images = 3
     if "custom_system_prompt" not in st.session_state:
@@ -73,6 +77,8 @@ def setup_state():
         st.session_state.hide_images = False
     if "in_sampling_loop" not in st.session_state:
         st.session_state.in_sampling_loop = False
+    if "http_logs_enabled" not in st.session_state:
+        st.session_state.http_logs_enabled = True
     if "output_tokens" not in st.session_state:
         st.session_state.output_tokens = 4096  # default max tokens per reply
 
@@ -105,6 +111,11 @@ async def main():
             help="Extra instructions appended to the base system prompt.",
         )
         st.checkbox("Hide screenshots", key="hide_images")
+        st.checkbox(
+            "Log HTTP exchanges",
+            key="http_logs_enabled",
+            help="Record every API request/response in the HTTP Exchange Logs tab.",
+        )
         st.number_input("Max Output Tokens", key="output_tokens", step=1)
 
         if st.button("Reset", type="primary"):
@@ -147,13 +158,15 @@ async def main():
             # nothing to respond to
             return
 
+        bot_message = _StreamingBotMessage()
         with track_sampling_loop():
             st.session_state.messages = await sampling_loop(
                 system_prompt_suffix=st.session_state.custom_system_prompt,
                 model=st.session_state.model,
                 provider=None,  # your loop ignores this
                 messages=st.session_state.messages,
-                output_callback=partial(_render_message, Sender.BOT),
+                output_callback=bot_message.finish,
+                output_delta_callback=bot_message.write,
                 tool_output_callback=partial(
                     _tool_output_callback, tool_state=st.session_state.tools
                 ),
@@ -161,7 +174,9 @@ async def main():
                     _api_response_callback,
                     tab=http_logs,
                     response_state=st.session_state.responses,
-                ),
+                )
+                if st.session_state.http_logs_enabled
+                else None,
                 api_key=st.session_state.api_key,
                 only_n_most_recent_images=st.session_state.only_n_most_recent_images,
                 max_tokens=st.session_state.output_tokens,
@@ -191,7 +206,7 @@ def _tool_output_callback(
     tool_output: ToolResult, tool_id: str, tool_state: dict[str, ToolResult]
 ):
     tool_state[tool_id] = tool_output
-    _render_message(Sender.TOOL, tool_output)
+    _render_message(Sender.TOOL, tool_output, tool_id)
 
 def _render_api_response(
     request: httpx.Request,
@@ -205,22 +220,29 @@ def _render_api_response(
             st.markdown(
                 f"`{request.method} {request.url}`{newline}{newline.join(f'`{k}: {v}`' for k, v in request.headers.items())}"
             )
-            try:
-                st.json(request.read().decode())
-            except Exception:
-                st.write(request.read())
+            # Bodies carry the whole conversation; only decode them on demand.
+            show_body = st.checkbox("Show full body", key=f"show_body_{response_id}")
+            if show_body:
+                _render_body(request.read())
             st.markdown("---")
             if isinstance(response, httpx.Response):
                 st.markdown(
                     f"`{response.status_code}`{newline}{newline.join(f'`{k}: {v}`' for k, v in response.headers.items())}"
                 )
-                try:
-                    st.json(response.text)
-                except Exception:
-                    st.write(response.text)
+                if show_body:
+                    try:
+                        _render_body(response.content)
+                    except httpx.ResponseNotRead:
+                        st.write("(streamed response body is not captured)")
             else:
                 st.write(response)
 
+def _render_body(body: bytes):
+    try:
+        st.json(msgspec.json.decode(body))
+    except msgspec.DecodeError:
+        st.write(body)
+
 def _render_any_message(message: dict):
     """
     Render a stored chat message in st.session_state.messages (OpenAI/Nebius format).
@@ -233,11 +255,15 @@ def _render_any_message(message: dict):
         tool_call_id = message.get("tool_call_id")
         tr = st.session_state.tools.get(tool_call_id)
         if tr:
-            _render_message(Sender.TOOL, tr)
+            _render_message(Sender.TOOL, tr, tool_call_id)
         else:
             _render_message(Sender.TOOL, content or "")
         return
 
+    # Assistant turns that only request tool calls have no text to show
+    if role == "assistant" and message.get("tool_calls") and not content:
+        return
+
     # Assistant / user
     if isinstance(content, str):
         _render_message(Sender.BOT if role == "assistant" else Sender.USER, content)
@@ -265,7 +291,32 @@ def _render_any_message(message: dict):
     else:
         _render_message(Sender.BOT if role == "assistant" else Sender.USER, str(content))
 
-def _render_message(sender: Sender, message: str | ToolResult):
+class _StreamingBotMessage:
+    """Paints assistant text while it streams in, then settles it as one message."""
+
+    def __init__(self):
+        self._placeholder: DeltaGenerator | None = None
+        self._text = ""
+
+    def write(self, delta: str):
+        if self._placeholder is None:
+            self._placeholder = st.chat_message(Sender.BOT).empty()
+        self._text += delta
+        self._placeholder.markdown(self._text)
+
+    def finish(self, text: str):
+        if self._placeholder is None:
+            # Turns that only call tools have no text; reruns skip them too.
+            if text:
+                _render_message(Sender.BOT, text)
+        else:
+            self._placeholder.markdown(text)
+        self._placeholder = None
+        self._text = ""
+
+def _render_message(
+    sender: Sender, message: str | ToolResult, tool_id: str | None = None
+):
     """Render a simple text or a ToolResult."""
     with st.chat_message(sender):
         if isinstance(message, ToolResult):
@@ -274,10 +325,19 @@ def _render_message(sender: Sender, message: str | ToolResult):
             if message.error:
                 st.error(message.error)
             if message.base64_image and not st.session_state.hide_images:
-                st.image(base64.b64decode(message.base64_image))
+                st.image(_screenshot_bytes(message.base64_image, tool_id))
         else:
             st.markdown(message)
 
+def _screenshot_bytes(b64: str, tool_id: str | None) -> bytes:
+    """Decode a tool screenshot once per tool call; the history re-renders it on every rerun."""
+    if tool_id is None:
+        return base64.b64decode(b64)
+    screenshots = st.session_state.screenshots
+    if tool_id not in screenshots:
+        screenshots[tool_id] = base64.b64decode(b64)
+    return screenshots[tool_id]
+
 # ----------------------------- Run -------------------------------------
 
 if __name__ == "__main__":
@@ -1,67 +1,297 @@
+import asyncio
+import base64
+import io
+import json
+from collections import OrderedDict
+from types import SimpleNamespace
 from unittest import mock
 
-from anthropic.types import TextBlock, ToolUseBlock
-from anthropic.types.beta import BetaMessage, BetaMessageParam, BetaTextBlockParam
+import httpx
+import openai
+import pytest
+from PIL import Image, ImageDraw
 
-from computer_use_demo.loop import APIProvider, sampling_loop
+from computer_use_demo import loop
+from computer_use_demo.loop import (
+    _maybe_filter_to_n_most_recent_images,
+    _split_batch_summaries,
+    _trim_to_request_window,
+    sampling_loop,
+    summarize_images_batch,
+)
+from computer_use_demo.tools import ToolResult
+
+
+def _chunk(content=None, tool_calls=None):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=SimpleNamespace(content=content, tool_calls=tool_calls))]
+    )
+
+
+def _tool_call_delta(index, call_id=None, name=None, arguments=None):
+    return SimpleNamespace(
+        index=index, id=call_id, function=SimpleNamespace(name=name, arguments=arguments)
+    )
 
 
 async def test_loop():
-    client = mock.Mock()
-    client.beta.messages.with_raw_response.create.return_value = mock.Mock()
-    client.beta.messages.with_raw_response.create.return_value.parse.side_effect = [
-        mock.Mock(
-            spec=BetaMessage,
-            content=[
-                TextBlock(type="text", text="Hello"),
-                ToolUseBlock(
-                    type="tool_use", id="1", name="computer", input={"action": "test"}
-                ),
-            ],
-        ),
-        mock.Mock(spec=BetaMessage, content=[TextBlock(type="text", text="Done!")]),
+    tool_collection = mock.AsyncMock()
+    tool_collection.run.side_effect = [
+        ToolResult(output="moved"),
+        ToolResult(output="clicked"),
     ]
+    dispatched_while_streaming = []
 
-    tool_collection = mock.AsyncMock()
-    tool_collection.run.return_value = mock.Mock(
-        output="Tool output", error=None, base64_image=None
+    async def stream(chunks):
+        for chunk in chunks:
+            yield chunk
+            await asyncio.sleep(0)
+        dispatched_while_streaming.append(tool_collection.run.await_count)
+
+    turns = [
+        [
+            _chunk("Moving"),
+            # the first call's arguments arrive split across chunks
+            _chunk(tool_calls=[_tool_call_delta(0, "a", "computer", '{"action": "mouse_')]),
+            _chunk(tool_calls=[_tool_call_delta(0, arguments='move", "coordinate": [1, 2]}')]),
+            _chunk(" now"),
+            _chunk(tool_calls=[_tool_call_delta(1, "b", "computer", '{"action": "left_click"}')]),
+        ],
+        [_chunk("Done!")],
+    ]
+
+    client = mock.MagicMock()
+    client.__aenter__.return_value = client
+    client.chat.completions.create = mock.AsyncMock(
+        side_effect=lambda **kwargs: stream(turns.pop(0))
     )
 
     output_callback = mock.Mock()
     tool_output_callback = mock.Mock()
-    api_response_callback = mock.Mock()
 
     with mock.patch(
-        "computer_use_demo.loop.Anthropic", return_value=client
+        "computer_use_demo.loop.AsyncOpenAI", return_value=client
     ), mock.patch(
         "computer_use_demo.loop.ToolCollection", return_value=tool_collection
     ):
-        messages: list[BetaMessageParam] = [{"role": "user", "content": "Test message"}]
+        messages = [{"role": "user", "content": "Test message"}]
         result = await sampling_loop(
             model="test-model",
-            provider=APIProvider.ANTHROPIC,
-            system_prompt_suffix="",
             messages=messages,
             output_callback=output_callback,
             tool_output_callback=tool_output_callback,
-            api_response_callback=api_response_callback,
             api_key="test-key",
-            tool_version="computer_use_20250124",
         )
 
-        assert len(result) == 4
-        assert result[0] == {"role": "user", "content": "Test message"}
-        assert result[1]["role"] == "assistant"
-        assert result[2]["role"] == "user"
-        assert result[3]["role"] == "assistant"
+    assert result[1] == {
+        "role": "assistant",
+        "content": "Moving now",
+        "tool_calls": [
+            {
+                "id": "a",
+                "type": "function",
+                "function": {
+                    "name": "computer",
+                    "arguments": '{"action": "mouse_move", "coordinate": [1, 2]}',
+                },
+            },
+            {
+                "id": "b",
+                "type": "function",
+                "function": {"name": "computer", "arguments": '{"action": "left_click"}'},
+            },
+        ],
+    }
+    assert all(type(tool_call) is dict for tool_call in result[1]["tool_calls"])
+    assert [message["tool_call_id"] for message in result[2:4]] == ["a", "b"]
+    assert result[4] == {"role": "assistant", "content": "Done!"}
+    assert len(result) == 5
+
+    # the first call ran before the stream ended, in model order with the second
+    assert dispatched_while_streaming[0] >= 1
+    assert tool_collection.run.call_args_list == [
+        mock.call(name="computer", tool_input={"action": "mouse_move", "coordinate": [1, 2]}),
+        mock.call(name="computer", tool_input={"action": "left_click"}),
+    ]
+    assert tool_output_callback.call_args_list == [
+        mock.call(ToolResult(output="moved"), "a"),
+        mock.call(ToolResult(output="clicked"), "b"),
+    ]
+    assert output_callback.call_args_list == [mock.call("Moving now"), mock.call("Done!")]
+    assert client.chat.completions.create.call_count == 2
+
+
+async def test_loop_stream_error_is_not_wrapped():
+    async def stream():
+        yield _chunk(tool_calls=[_tool_call_delta(0, "a", "computer", '{"action": "left_click"}')])
+        raise httpx.ReadError("connection dropped")
 
-        assert client.beta.messages.with_raw_response.create.call_count == 2
-        tool_collection.run.assert_called_once_with(
-            name="computer", tool_input={"action": "test"}
+    client = mock.MagicMock()
+    client.__aenter__.return_value = client
+    client.chat.completions.create = mock.AsyncMock(return_value=stream())
+
+    with mock.patch(
+        "computer_use_demo.loop.AsyncOpenAI", return_value=client
+    ), mock.patch(
+        "computer_use_demo.loop.ToolCollection", return_value=mock.AsyncMock()
+    ), pytest.raises(httpx.ReadError):
+        await sampling_loop(
+            model="test-model",
+            messages=[{"role": "user", "content": "Test message"}],
+            output_callback=mock.Mock(),
+            tool_output_callback=mock.Mock(),
+            api_key="test-key",
         )
-        output_callback.assert_called_with(
-            BetaTextBlockParam(text="Done!", type="text", citations=None)
+
+
+def test_maybe_filter_to_n_most_recent_images():
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Hello"},
+                {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAA"}},
+            ],
+        },
+        {"role": "tool", "tool_call_id": "1", "content": json.dumps({"image": "first"})},
+        {"role": "tool", "tool_call_id": "2", "content": json.dumps({"image": "second"})},
+    ]
+
+    filtered = _maybe_filter_to_n_most_recent_images(messages, 1)
+
+    assert filtered[0]["content"][1] == {"type": "text", "text": "[image omitted]"}
+    assert json.loads(filtered[1]["content"]) == {"image": {"omitted": True}}
+    assert filtered[2] is messages[2]
+    # the caller's history is left untouched
+    assert messages[0]["content"][1]["type"] == "image_url"
+    assert json.loads(messages[1]["content"]) == {"image": "first"}
+    assert _maybe_filter_to_n_most_recent_images(messages, None) is messages
+
+
+def test_trim_to_request_window():
+    messages = [
+        {"role": "user", "content": "Task"},
+        {"role": "assistant", "content": "", "tool_calls": [{"id": "1"}]},
+        {"role": "tool", "tool_call_id": "1", "content": "{}"},
+        {"role": "assistant", "content": "", "tool_calls": [{"id": "2"}]},
+        {"role": "tool", "tool_call_id": "2", "content": "{}"},
+    ]
+
+    assert _trim_to_request_window(messages, 10) is messages
+    # the window would start on a tool result, so it moves past it
+    assert _trim_to_request_window(messages, 3) == [messages[0], *messages[3:]]
+
+
+async def test_summarize_images_batch_cache_requires_identical_screen():
+    def screenshot(ticked: bool) -> str:
+        image = Image.new("RGB", (1280, 800), (240, 240, 240))
+        draw = ImageDraw.Draw(image)
+        draw.rectangle([600, 390, 620, 410], outline=(0, 0, 0))
+        if ticked:
+            draw.line([604, 400, 609, 406, 617, 393], fill=(0, 0, 0), width=2)
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        return base64.b64encode(buffer.getvalue()).decode()
+
+    client = mock.Mock()
+    client.chat.completions.create = mock.AsyncMock(
+        side_effect=[
+            mock.Mock(choices=[mock.Mock(message=mock.Mock(content="unticked"))]),
+            mock.Mock(choices=[mock.Mock(message=mock.Mock(content="ticked"))]),
+        ]
+    )
+
+    with mock.patch("computer_use_demo.loop._VISION_CACHE", OrderedDict()):
+        before = await summarize_images_batch(client, [screenshot(False)], [])
+        again = await summarize_images_batch(client, [screenshot(False)], [])
+        # a ticked checkbox is a different screen, not a cache hit
+        after = await summarize_images_batch(client, [screenshot(True)], [])
+
+    assert (*before, *again, *after) == ("unticked", "unticked", "ticked")
+    assert client.chat.completions.create.call_count == 2
+
+
+def test_split_batch_summaries():
+    # a widened rule still separates, an inline "---" does not
+    assert _split_batch_summaries("Image 1: a\n-----\nImage 2: b") == [
+        "Image 1: a",
+        "Image 2: b",
+    ]
+    assert _split_batch_summaries("a --- b\n---\nc\n---\n") == ["a --- b", "c"]
+
+
+async def test_summarize_images_batch_falls_back_on_count_mismatch():
+    def screenshot(angle: int) -> str:
+        buffer = io.BytesIO()
+        Image.linear_gradient("L").rotate(angle).save(buffer, "PNG")
+        return base64.b64encode(buffer.getvalue()).decode()
+
+    def reply(content: str):
+        return mock.Mock(choices=[mock.Mock(message=mock.Mock(content=content))])
+
+    async def create(*, messages, **kwargs):
+        images = [part for part in messages[-1]["content"] if part["type"] == "image_url"]
+        return reply("one description only" if len(images) > 1 else "single")
+
+    client = mock.Mock()
+    client.chat.completions.create = mock.AsyncMock(side_effect=create)
+
+    with mock.patch(
+        "computer_use_demo.loop._VISION_CACHE", OrderedDict()
+    ), mock.patch(
+        "computer_use_demo.loop._fingerprint_screenshot",
+        side_effect=loop._fingerprint_screenshot,
+    ) as fingerprint:
+        summaries = await summarize_images_batch(
+            client, [screenshot(0), screenshot(90)], []
         )
-        assert output_callback.call_count == 3
-        assert tool_output_callback.call_count == 1
-        assert api_response_callback.call_count == 2
+
+    assert summaries == ["single", "single"]
+    # one batched request, then one request per image
+    assert client.chat.completions.create.call_count == 3
+    # the fallback reuses the decoded, hashed screenshots
+    assert fingerprint.call_count == 2
+
+
+async def test_summarize_images_batch_describes_repeated_screen_once():
+    def screenshot(angle: int) -> str:
+        buffer = io.BytesIO()
+        Image.linear_gradient("L").rotate(angle).save(buffer, "PNG")
+        return base64.b64encode(buffer.getvalue()).decode()
+
+    client = mock.Mock()
+    client.chat.completions.create = mock.AsyncMock(
+        return_value=mock.Mock(choices=[mock.Mock(message=mock.Mock(content="first\n---\nsecond"))])
+    )
+
+    with mock.patch("computer_use_demo.loop._VISION_CACHE", OrderedDict()):
+        summaries = await summarize_images_batch(
+            client, [screenshot(0), screenshot(90), screenshot(0)], []
+        )
+
+    assert summaries == ["first", "second", "first"]
+    (call,) = client.chat.completions.create.await_args_list
+    images = [part for part in call.kwargs["messages"][-1]["content"] if part["type"] == "image_url"]
+    assert len(images) == 2
+
+
+async def test_summarize_images_batch_raises_api_errors():
+    def screenshot(angle: int) -> str:
+        buffer = io.BytesIO()
+        Image.linear_gradient("L").rotate(angle).save(buffer, "PNG")
+        return base64.b64encode(buffer.getvalue()).decode()
+
+    request = httpx.Request("POST", "https://api.studio.nebius.ai/v1/chat/completions")
+    error = openai.RateLimitError(
+        "rate limited", response=httpx.Response(429, request=request), body=None
+    )
+    client = mock.Mock()
+    client.chat.completions.create = mock.AsyncMock(side_effect=error)
+
+    with mock.patch(
+        "computer_use_demo.loop._VISION_CACHE", OrderedDict()
+    ), pytest.raises(openai.RateLimitError):
+        await summarize_images_batch(client, [screenshot(0), screenshot(90)], [])
+
+    # no per-image requests after the batch was rejected
+    assert client.chat.completions.create.call_count == 1